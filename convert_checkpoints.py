@@ -22,17 +22,20 @@ python convert_checkpoint.py \
     --output_checkpoint_dir=${output_ckpt_dir}
 """
 
+import collections.abc
+import concurrent.futures
 import gc
 import hashlib
 import json
 import os
+import struct
 import time
 
 from absl import app
 from absl import flags
 from etils import epath
 
-from safetensors.torch import save_file
+from safetensors import safe_open
 import torch
 from google.cloud import storage
 
@@ -54,7 +57,8 @@ _OUTPUT_CHECKPOINT_DIR = epath.DEFINE_path(
 _MINIMIZE_MEMORY_FOOTPRINT = flags.DEFINE_bool(
     "minimize_memory_footprint",
     False,
-    "When set to true, reduce memory usage by staging in-memory data on disk",
+    "When set to true, reduce memory usage by releasing sharded weights as they"
+    " are merged",
 )
 
 _ENABLE_FLOAT32 = flags.DEFINE_bool(
@@ -68,6 +72,12 @@ _OUTPUT_SAFETENSORS = flags.DEFINE_bool(
     True,
     "When set to true, save to HugginFace SafeTensors format",
 )
+_VERIFY_SHARDS = flags.DEFINE_bool(
+    "verify_shards",
+    True,
+    "When set to false, skip checking that sharded weights have the same"
+    " shape. Only use it for checkpoints that are known to be valid",
+)
 _QUANTIZE = flags.DEFINE_bool(
     "quantize", False, "When set to true, produces quantized weights"
 )
@@ -93,6 +103,19 @@ _WEIGHT_SHARDING_TYPE = {
     "output.weight": "ColumnParallelLinear",
 }
 
+_SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
 _LLAMA_QUANTIZED_WEIGHTS_TO_SCALER_NAME = {
     "tok_embeddings.weight": "tok_embeddings.weight_scaler",
     "attention.wq.weight": "attention.wq.weight_scaler",
@@ -117,12 +140,41 @@ _GEMMA_QUANTIZED_WEIGHTS_TO_SCALER_NAME = {
 }
 
 
+def _quantize_weight_int8(val, reduce_axis):
+  """Run quantize_torch_int8 in float32 and keep the scale in val's dtype.
+
+  Inductor computes bf16 math in float32, so quantizing in float32 explicitly
+  makes the compiled and eager results identical.
+  """
+  vals, scale = quantize.quantize_torch_int8(val.float(), reduce_axis)
+  return vals, scale.to(val.dtype)
+
+
+_quantize_torch_int8_fn = torch.compile(_quantize_weight_int8, dynamic=True)
+
+
+def _quantize_torch_int8(val, reduce_axis):
+  """Quantize a weight with the kernel fused by torch.compile.
+
+  Inductor needs a C++ toolchain on CPU. Without one, fall back to eager,
+  which gives the same results.
+  """
+  global _quantize_torch_int8_fn  # pylint: disable=global-statement
+  try:
+    return _quantize_torch_int8_fn(val, reduce_axis)
+  # pylint: disable-next=protected-access
+  except torch._dynamo.exc.BackendCompilerFailed as e:
+    print(f"torch.compile failed ({e}), quantizing in eager mode instead.")
+    _quantize_torch_int8_fn = _quantize_weight_int8
+    return _quantize_torch_int8_fn(val, reduce_axis)
+
+
 def _quantize_state_dict(state_dict, weight_map, weight_axis):
   updated_weights = {}
   for key, val in state_dict.items():
     for qname, qscale_name in weight_map.items():
       if key.endswith(qname):
-        new_weights, scaler = quantize.quantize_torch_int8(
+        new_weights, scaler = _quantize_torch_int8(
             val, reduce_axis=(weight_axis(key),)
         )
         updated_weights[key] = new_weights
@@ -132,19 +184,30 @@ def _quantize_state_dict(state_dict, weight_map, weight_axis):
   return state_dict
 
 
-def _compute_md5(file_path: epath.Path) -> str:
-  md5_hash = hashlib.md5()
+def _compute_sha256(file_path: epath.Path) -> str:
   with file_path.open("rb") as file:
+    # hashlib.file_digest (Python 3.11+) hashes the file in C without
+    # iterating over chunks in Python.
+    if hasattr(hashlib, "file_digest") and hasattr(file, "readinto"):
+      return hashlib.file_digest(file, "sha256").hexdigest()
+    sha256_hash = hashlib.sha256()
     # Use larger buffer for better read throughput,
     # since checkpoint file is typically tens of GBs in size.
-    while data := file.read(256 * 1024):
-      md5_hash.update(data)
-  return md5_hash.hexdigest()
+    while data := file.read(4 * 1024 * 1024):
+      sha256_hash.update(data)
+  return sha256_hash.hexdigest()
 
 
-def _generate_md5_checklist(target_dir: epath.Path) -> None:
+def _generate_sha256_checklist(target_dir: epath.Path) -> None:
   files = [target_dir / file for file in target_dir.iterdir() if file.is_file()]
-  return "\n".join([f"{_compute_md5(f)}\n" for f in files]) + "\n"
+  if not files:
+    return "\n"
+  # hashlib releases the GIL on large buffers, so files are hashed in parallel.
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=min(8, len(files))
+  ) as executor:
+    digests = list(executor.map(_compute_sha256, files))
+  return "\n".join([f"{digest}\n" for digest in digests]) + "\n"
 
 
 def _checkpoints_have_same_weight_keys(
@@ -152,101 +215,152 @@ def _checkpoints_have_same_weight_keys(
 ):
   if (not checkpoint_list) or len(checkpoint_list) <= 1:
     return True
-  for m in checkpoint_list[1:]:
-    if set(checkpoint_list[0].keys()) != set(m.keys()):
-      return False
-  return True
+  ref_keys = frozenset(checkpoint_list[0].keys())
+  return all(m.keys() == ref_keys for m in checkpoint_list[1:])
 
 
 def _tensors_have_same_shape(tensors):
+  return len({t.shape for t in tensors}) <= 1
+
+
+def _lookup_sharding_type(key):
+  """Find the sharding type of a weight from the dotted suffixes of its key.
+
+  Returns a (found, kind) tuple, since None is itself a valid kind.
+  """
+  tokens = key.split(".")
+  for i in range(len(tokens) - 1, -1, -1):
+    suffix = ".".join(tokens[i:])
+    if suffix in _WEIGHT_SHARDING_TYPE:
+      return True, _WEIGHT_SHARDING_TYPE[suffix]
+  return False, None
+
+
+def _tensors_are_identical(tensors, atol=1e-6):
   if (not tensors) or len(tensors) <= 1:
     return True
-  for t in tensors[1:]:
-    if t.shape != tensors[0].shape:
-      return False
-  return True
+  ref = tensors[0]
+  # Subtraction would broadcast, so shards of another shape never match.
+  if any(t.shape != ref.shape for t in tensors[1:]):
+    return False
+  # Shards viewing the same memory with the same layout are trivially
+  # identical.
+  if all(
+      t.data_ptr() == ref.data_ptr() and t.stride() == ref.stride()
+      for t in tensors[1:]
+  ):
+    return True
+  diffs = torch.stack([(t - ref).abs().max() for t in tensors[1:]])
+  return diffs.max().item() <= atol
+
+
+def _cat_as(tensors, dim, dtype=None):
+  """torch.cat the shards along dim, casting them to dtype while copying.
+
+  Writing into an out tensor of the target dtype merges and converts the
+  shards in one allocation, instead of a torch.cat followed by a cast.
+  torch.cat still rejects shards whose other dimensions do not match.
+  """
+  shape = list(tensors[0].shape)
+  shape[dim] = sum(t.shape[dim] for t in tensors)
+  out = torch.empty(shape, dtype=dtype or tensors[0].dtype)
+  return torch.cat(tensors, dim, out=out)
 
 
 # pylint: disable-next=all
 def _merge_llama_weights(
-    checkpoints, minimize_memory_footprint, enable_float32
+    checkpoints, minimize_memory_footprint, enable_float32, verify_shards=True
 ):
   print("Starting to merge weights.")
   state_dict = {}
-  tmp_dir: epath.Path = None
   if minimize_memory_footprint:
-    # tmp_dir = output_ckpt_dir / 'tmp'
-    # Store the temp data locally
-    tmp_dir = epath.Path("/tmp/checkpoints")
-    tmp_dir.mkdir(parents=True, exist_ok=True)
-    print(f"Stage in-memory data on disk {tmp_dir} to reduce memory uage")
+    print("Release sharded weights as soon as they are merged")
   if not _checkpoints_have_same_weight_keys(checkpoints):
     raise ValueError("Checkpoint must have the same set of weights.")
-  weight_keys = checkpoints[0].keys()
+  weight_keys = list(checkpoints[0].keys())
   for key in weight_keys:
     tensors: list[torch.Tensor] = [c[key] for c in checkpoints]
-    if not _tensors_have_same_shape(tensors):
+    if verify_shards and not _tensors_have_same_shape(tensors):
       raise ValueError(f"Tensors must have the same shape for {key}")
     print(
         "Merging weights across "
         f"{len(tensors)} shards (shape = {tensors[0].shape}) for {key})"
     )
     state_dict_for_key = {}
-    for pattern, kind in _WEIGHT_SHARDING_TYPE.items():
-      if not key.endswith(pattern):
-        continue
+    found, kind = _lookup_sharding_type(key)
+    if found:
+      dtype = torch.float32 if enable_float32 else None
       with torch.no_grad():
         if kind in ("ParallelEmbedding", "RowParallelLinear"):
-          state_dict_for_key[key] = torch.cat(tensors, 1)
+          state_dict_for_key[key] = _cat_as(tensors, 1, dtype)
         elif kind == "ColumnParallelLinear":
-          state_dict_for_key[key] = torch.cat(tensors, 0)
+          state_dict_for_key[key] = _cat_as(tensors, 0, dtype)
         else:
-          if not all(
-              torch.allclose(tensors[0], tensor, atol=1e-6)
-              for tensor in tensors[1:]
-          ):
+          if not _tensors_are_identical(tensors):
             raise ValueError(
                 f"Tensors must be identical across shards for {key}"
             )
           state_dict_for_key[key] = tensors[0]
-
-        if enable_float32:
-          state_dict_for_key[key] = state_dict_for_key[key].float()
+          if enable_float32:
+            state_dict_for_key[key] = state_dict_for_key[key].float()
+    state_dict.update(state_dict_for_key)
     if minimize_memory_footprint:
-      # Stage this merged weights on disk to reduce memory footprint.
-      torch.save(state_dict_for_key, os.fspath(tmp_dir / (key + ".pth")))
-      del state_dict_for_key
+      # Drop the sharded weights of this key once they are merged, so the
+      # peak memory stays close to one copy of the model instead of staging
+      # merged weights on disk and loading them back.
+      del tensors, state_dict_for_key
+      for c in checkpoints:
+        del c[key]
       gc.collect()
-    else:
-      state_dict.update(state_dict_for_key)
 
-  if minimize_memory_footprint:
-    # Release weights loaded into memory from the original checkpoint dir
-    # before loading merged weights that were starged on disk.
-    # Doing so could help with reducing memory usage.
-    del checkpoints
-    gc.collect()
-    paths = tmp_dir.glob("*.pth")
-    paths = sorted(paths)
-    for path in paths:
-      state_dict.update(
-          torch.load(os.fspath(path), map_location=torch.device("cpu"))
-      )
-      # Delete the individual merged weight file to free up disk space
-      # for merged single weight file below.
-      epath.Path(path).unlink()
-    tmp_dir.rmtree()
   return state_dict
 
 
+class _LazySafetensorsCheckpoint(collections.abc.MutableMapping):
+  """Checkpoint shard that reads tensors from a safetensors file on demand.
+
+  Deleting a key only forgets it, so the merged shard can be released key by
+  key just like a checkpoint loaded with torch.load. The file handle is closed
+  once the last key is deleted, or explicitly with close().
+  """
+
+  def __init__(self, path):
+    self._file = safe_open(os.fspath(path), framework="pt", device="cpu")
+    self._keys = dict.fromkeys(self._file.keys())
+
+  def close(self):
+    """Release the safetensors file handle."""
+    self._keys.clear()
+    self._file = None
+
+  def __getitem__(self, key):
+    if key not in self._keys:
+      raise KeyError(key)
+    return self._file.get_tensor(key)
+
+  def __setitem__(self, key, value):
+    raise TypeError("Safetensors checkpoints are read only")
+
+  def __delitem__(self, key):
+    del self._keys[key]
+    if not self._keys:
+      self.close()
+
+  def __iter__(self):
+    return iter(self._keys)
+
+  def __len__(self):
+    return len(self._keys)
+
+
 def _load_from_gcs(input_ckpt_dir: epath.Path):
-  checkpoints = []
   input_ckpt_dir_str = str(input_ckpt_dir)
   # pylint: disable-next=all
   bucket_name, blob_name = input_ckpt_dir_str.split("//")[-1].split("/", 1)
   print(f"Bucket {bucket_name}, blob {blob_name}")
   storage_client = storage.Client()
   input_blobs = storage_client.list_blobs(bucket_name, prefix=blob_name)
+  checkpoint_blobs = []
   for blob in input_blobs:
     if "params.json" in blob.name:
       with blob.open("r") as f:
@@ -255,10 +369,20 @@ def _load_from_gcs(input_ckpt_dir: epath.Path):
         f.close()
         print("params: ", params)
     if ".pth" in blob.name:
-      print(f"Loading checkpoint files from {blob.name}")
-      with blob.open("rb") as f:
-        checkpoints += torch.load(f, map_location=torch.device("cpu"))
-        f.close()
+      checkpoint_blobs.append(blob)
+
+  def load_blob(blob):
+    print(f"Loading checkpoint files from {blob.name}")
+    with blob.open("rb") as f:
+      return torch.load(f, map_location=torch.device("cpu"))
+
+  # Downloads are IO bound, so fetch all shards concurrently.
+  checkpoints = []
+  if checkpoint_blobs:
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(len(checkpoint_blobs), os.cpu_count() or 1)
+    ) as executor:
+      checkpoints = list(executor.map(load_blob, checkpoint_blobs))
   return checkpoints, params
 
 
@@ -267,17 +391,73 @@ def _load_from_local(input_ckpt_dir: epath.Path):
   params = json.loads((input_ckpt_dir / "params.json").read_text())
 
   print(f"Loading checkpoint files from {input_ckpt_dir}.")
-  paths = input_ckpt_dir.glob("*.pth")
-  paths = sorted(paths)
-  checkpoints = [
-      torch.load(os.fspath(path), map_location=torch.device("cpu"))
-      for path in paths
-  ]
+  safetensors_paths = sorted(input_ckpt_dir.glob("*.safetensors"))
+  paths = sorted(input_ckpt_dir.glob("*.pth"))
+  if safetensors_paths and paths:
+    raise ValueError(
+        f"Found both *.safetensors and *.pth in the input dir {input_ckpt_dir},"
+        " keep only one format"
+    )
+  if safetensors_paths:
+    print(f"Loading {len(safetensors_paths)} *.safetensors shards.")
+    # Tensors are read lazily while merging, one key at a time.
+    checkpoints = [
+        _LazySafetensorsCheckpoint(path) for path in safetensors_paths
+    ]
+    return checkpoints, params
+
+  def load_path(path):
+    return torch.load(os.fspath(path), map_location=torch.device("cpu"))
+
+  # torch.load releases the GIL while reading, so load shards concurrently.
+  if paths:
+    print(f"Loading {len(paths)} *.pth shards.")
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(len(paths), os.cpu_count() or 1)
+    ) as executor:
+      checkpoints = list(executor.map(load_path, paths))
   if not checkpoints:
-    raise ValueError(f"No *.pth found in the input dir {input_ckpt_dir}")
+    raise ValueError(
+        f"No *.safetensors or *.pth found in the input dir {input_ckpt_dir}"
+    )
   return checkpoints, params
 
 
+def _save_safetensors_streaming(state_dict, path):
+  """Write state_dict to a safetensors file one tensor at a time.
+
+  Unlike safetensors.torch.save_file, this never serializes the whole model
+  into one buffer. Each tensor is removed from state_dict once written, so
+  peak memory only grows by the size of the largest tensor.
+  """
+  # Larger dtypes first (as safetensors does) keeps every tensor aligned.
+  keys = sorted(state_dict, key=lambda k: (-state_dict[k].element_size(), k))
+  header = {}
+  offset = 0
+  for key in keys:
+    tensor = state_dict[key]
+    if tensor.dtype not in _SAFETENSORS_DTYPES:
+      raise ValueError(
+          f"Unsupported dtype {tensor.dtype} for {key} in safetensors"
+      )
+    size = tensor.numel() * tensor.element_size()
+    header[key] = {
+        "dtype": _SAFETENSORS_DTYPES[tensor.dtype],
+        "shape": list(tensor.shape),
+        "data_offsets": [offset, offset + size],
+    }
+    offset += size
+  header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+  header_bytes += b" " * (-len(header_bytes) % 8)
+
+  with open(path, "wb") as f:
+    f.write(struct.pack("<Q", len(header_bytes)))
+    f.write(header_bytes)
+    for key in keys:
+      tensor = state_dict.pop(key).contiguous().reshape(-1)
+      f.write(tensor.view(torch.uint8).numpy().data)
+
+
 def _export_to_gcs(output_ckpt_dir: epath.Path, params, state_dict):
   # pylint: disable-next=all
   bucket_name, output_ckpt = str(output_ckpt_dir).split("//")[-1].split("/", 1)
@@ -287,7 +467,7 @@ def _export_to_gcs(output_ckpt_dir: epath.Path, params, state_dict):
 
   ckpt_blob = bucket.blob(os.path.join(output_ckpt, "consolidated.00.pth"))
   param_blob = bucket.blob(os.path.join(output_ckpt, "params.json"))
-  checklist_blob = bucket.blob(os.path.join(output_ckpt, "checklist.chk"))
+  checklist_blob = bucket.blob(os.path.join(output_ckpt, "checklist.sha256"))
   with param_blob.open("w") as f:
     f.write(json.dumps(params))
     f.close()
@@ -295,7 +475,7 @@ def _export_to_gcs(output_ckpt_dir: epath.Path, params, state_dict):
     torch.save(state_dict, f)
     f.close()
   with checklist_blob.open("w") as f:
-    f.write(_generate_md5_checklist(output_ckpt_dir))
+    f.write(_generate_sha256_checklist(output_ckpt_dir))
     f.close()
 
 
@@ -303,11 +483,13 @@ def _export_to_local(output_ckpt_dir: epath.Path, params, state_dict):
   output_ckpt_dir.mkdir(parents=True, exist_ok=True)
   (output_ckpt_dir / "params.json").write_text(json.dumps(params))
   if _OUTPUT_SAFETENSORS.value:
-    save_file(state_dict, os.fspath(output_ckpt_dir / "model.safetensors"))
+    _save_safetensors_streaming(
+        state_dict, os.fspath(output_ckpt_dir / "model.safetensors")
+    )
   else:
     torch.save(state_dict, os.fspath(output_ckpt_dir / "consolidated.00.pth"))
-    checklist_file = output_ckpt_dir / "checklist.chk"
-    checklist_file.write_text(_generate_md5_checklist(output_ckpt_dir))
+    checklist_file = output_ckpt_dir / "checklist.sha256"
+    checklist_file.write_text(_generate_sha256_checklist(output_ckpt_dir))
 
 
 def _get_llama_state_dict(input_ckpt_dir):
@@ -325,7 +507,10 @@ def _get_llama_state_dict(input_ckpt_dir):
 
   start = time.perf_counter()
   state_dict = _merge_llama_weights(
-      checkpoints, _MINIMIZE_MEMORY_FOOTPRINT.value, _ENABLE_FLOAT32.value
+      checkpoints,
+      _MINIMIZE_MEMORY_FOOTPRINT.value,
+      _ENABLE_FLOAT32.value,
+      _VERIFY_SHARDS.value,
   )
   end = time.perf_counter()
   print(f"Merging weights takes {end - start} seconds")
@@ -340,6 +525,8 @@ def _get_gemma_state_dict(input_ckpt_dir):
       "model_state_dict"
   ]
   model_config = json.loads((input_ckpt_dir / "config.json").read_text())
+  q_dim = model_config["num_attention_heads"] * model_config["head_dim"]
+  kv_dim = model_config["num_key_value_heads"] * model_config["head_dim"]
   for key in list(state_dict.keys()):
     if state_dict[key].dtype.is_complex and _OUTPUT_SAFETENSORS.value:
       assert (
@@ -354,17 +541,11 @@ def _get_gemma_state_dict(input_ckpt_dir):
     if key.startswith(prefix_to_remove):
       new_key = new_key.removeprefix(prefix_to_remove)
     if "qkv_proj" in key:
-      q_dim = model_config["num_attention_heads"] * model_config["head_dim"]
-      kv_dim = model_config["num_key_value_heads"] * model_config["head_dim"]
       qkv = state_dict.pop(key)
-      q, k, v = qkv.split(
-          [
-              q_dim,
-              kv_dim,
-              kv_dim,
-          ],
-          dim=0,
-      )
+      # narrow returns views into qkv, so no copy is made here.
+      q = qkv.narrow(0, 0, q_dim)
+      k = qkv.narrow(0, q_dim, kv_dim)
+      v = qkv.narrow(0, q_dim + kv_dim, kv_dim)
       state_dict[new_key.replace("qkv_proj", "wq")] = q
       state_dict[new_key.replace("qkv_proj", "wk")] = k
       state_dict[new_key.replace("qkv_proj", "wv")] = v
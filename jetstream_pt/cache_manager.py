@@ -12,12 +12,47 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+
 import jax
 import jax.numpy as jnp
 import torch
+from jetstream_pt import quantize
 from jetstream_pt import torchjax
 
 
+def _cache_index(pos):
+  """Cache position as a scalar, pos is an int, a list or an array."""
+  return jnp.reshape(jnp.asarray(pos), (-1,))[0]
+
+
+@functools.partial(jax.jit, donate_argnums=(0, 1))
+def _scatter_kv(cache_k, cache_v, key, value, pos):
+  """Write key and value into the caches at pos, reusing the cache buffers."""
+  index = _cache_index(pos)
+  cache_k = jax.lax.dynamic_update_index_in_dim(cache_k, key, index, axis=2)
+  cache_v = jax.lax.dynamic_update_index_in_dim(cache_v, value, index, axis=2)
+  return cache_k, cache_v
+
+
+@functools.partial(jax.jit, donate_argnums=(0,))
+def _int8_scatter(caches, updates, pos):
+  """Write quantized key/value and their scalers in one donated kernel.
+
+  caches is (cache_k, cache_v, k_scaler, v_scaler) and updates is
+  (k_quant, v_quant, kscale, vscale).
+  """
+  cache_k, cache_v, k_scaler, v_scaler = caches
+  k_quant, v_quant, kscale, vscale = updates
+  index = _cache_index(pos)
+  cache_k = jax.lax.dynamic_update_index_in_dim(cache_k, k_quant, index, 2)
+  cache_v = jax.lax.dynamic_update_index_in_dim(cache_v, v_quant, index, 2)
+  kscale, vscale = kscale.astype(k_scaler.dtype), vscale.astype(v_scaler.dtype)
+  k_scaler = jax.lax.dynamic_update_index_in_dim(k_scaler, kscale, index, 2)
+  v_scaler = jax.lax.dynamic_update_index_in_dim(v_scaler, vscale, index, 2)
+  return cache_k, cache_v, k_scaler, v_scaler
+
+
 # pylint: disable-next=all
 class CacheInterface:
   """Kv cache interface"""
@@ -35,6 +70,7 @@ class CacheInterface:
     """
 
 
+@jax.tree_util.register_pytree_node_class
 class KVCachePrefill:
   """Prefill kv cache"""
 
@@ -48,8 +84,10 @@ class KVCachePrefill:
     self.cache_k = key
     self.cache_v = value
     if self.kv_quantize:  # pretend to be quantized
-      bsz, _, seq, _ = key.shape
-      ones = torchjax.to_torch(jnp.ones((bsz, 1, seq, 1), dtype=jnp.bfloat16))
+      bsz, heads, seq, _ = key.shape
+      ones = torchjax.to_torch(
+          jnp.ones((bsz, heads, seq, 1), dtype=jnp.bfloat16)
+      )
       return key, value, ones, ones
 
     return key, value
@@ -58,30 +96,21 @@ class KVCachePrefill:
     """Get prefill cache state"""
     return self.cache_k, self.cache_v
 
+  def tree_flatten(self):
+    """Flatten into jax arrays, caches are None before the first update"""
+    return torchjax.from_torch((self.cache_k, self.cache_v)), self.kv_quantize
 
-# pylint: disable-next=all
-def KVCachePrefill_flatten(cache):
-  return (
-      torchjax.from_torch((cache.cache_k, cache.cache_v)),
-      cache.kv_quantize,
-  )
-
-
-# pylint: disable-next=all
-def KVCachePrefill_unflatten(auxdata, data):
-  cache = KVCachePrefill(auxdata)
-  cache_k, cache_v = torchjax.from_torch(data)
-  cache.cache_k = cache_k
-  cache.cache_v = cache_v
-
-
-jax.tree_util.register_pytree_node(
-    KVCachePrefill, KVCachePrefill_flatten, KVCachePrefill_unflatten
-)
+  @classmethod
+  def tree_unflatten(cls, auxdata, data):
+    """Rebuild the cache from flattened jax arrays"""
+    cache = cls(auxdata)
+    cache.cache_k, cache.cache_v = torchjax.to_torch(data)
+    return cache
 
 
 # Refactor out cache management
 # Easier to test for quantized kv cache
+@jax.tree_util.register_pytree_node_class
 class KVCacheGenerate:
   """Kvache generator without quantization"""
 
@@ -89,7 +118,7 @@ class KVCacheGenerate:
       self,
       cache_k: torch.Tensor,  # previous cache
       cache_v: torch.Tensor,  # previous cache
-      position: int,  # position to store the cache
+      position,  # position to store the cache, int or array of shape (1,)
       sharding,
   ):
     super().__init__()
@@ -100,11 +129,14 @@ class KVCacheGenerate:
 
   def update(self, key, value):
     """Update kv cache"""
-    keyj, valuej = torchjax.to_torch((key, value))
+    keyj, valuej = torchjax.from_torch((key, value))
+    cache_k, cache_v = _scatter_kv(
+        self.cache_k.jax(), self.cache_v.jax(), keyj, valuej, self.pos
+    )
     # pylint: disable-next=all
-    self.cache_k._elem = self.cache_k._elem.at[:, :, self.pos].set(keyj)
+    self.cache_k._elem = cache_k
     # pylint: disable-next=all
-    self.cache_v._elem = self.cache_v._elem.at[:, :, self.pos].set(valuej)
+    self.cache_v._elem = cache_v
     return self.cache_k, self.cache_v
 
   def state(self):
@@ -121,26 +153,16 @@ class KVCacheGenerate:
     k, v = torchjax.to_torch((k, v))
     return cls(k, v, 0, device)
 
+  def tree_flatten(self):
+    """Flatten into jax arrays, the sharding is static"""
+    return (self.cache_k.jax(), self.cache_v.jax(), self.pos), self.sharding
 
-# pylint: disable-next=all
-def KVCacheGenerate_flatten(cache):
-  return ((cache.cache_k.jax(), cache.cache_v.jax())), (
-      cache.pos.jax(),
-      cache.sharding.jax(),
-  )
-
-
-# pylint: disable-next=all
-def KVCacheGenerate_unflatten(auxdata, data):
-  position, sharding = auxdata
-  cache_k, cache_v = torchjax.to_torch(data)
-  cache = KVCacheGenerate(cache_k, cache_v, position, sharding)
-  return cache
-
-
-jax.tree_util.register_pytree_node(
-    KVCacheGenerate, KVCacheGenerate_flatten, KVCacheGenerate_unflatten
-)
+  @classmethod
+  def tree_unflatten(cls, auxdata, data):
+    """Rebuild the cache from flattened jax arrays"""
+    cache_k, cache_v, position = data
+    cache_k, cache_v = torchjax.to_torch((cache_k, cache_v))
+    return cls(cache_k, cache_v, position, auxdata)
 
 
 class Int8KVCacheGenerate:
@@ -179,8 +201,8 @@ class Int8KVCacheGenerate:
     cache_k = jnp.zeros(shape, device=device, dtype=jnp.int8)
     cache_v = jnp.zeros(shape, device=device, dtype=jnp.int8)
     # bf16_enable is a placeholder parameter, it's not used in Int8KVCache
-    kscaler = jnp.ones((shape[0], 1, shape[2], 1), dtype=jnp.bfloat16)
-    vscaler = jnp.ones((shape[0], 1, shape[2], 1), dtype=jnp.bfloat16)
+    kscaler = jnp.ones((shape[0], shape[1], shape[2], 1), dtype=jnp.bfloat16)
+    vscaler = jnp.ones((shape[0], shape[1], shape[2], 1), dtype=jnp.bfloat16)
 
     cache_k, cache_v, kscaler, vscaler = torchjax.to_torch(
         (cache_k, cache_v, kscaler, vscaler)
@@ -189,17 +211,22 @@ class Int8KVCacheGenerate:
 
   def quantize(self, val):
     """Quantize value"""
-    # val is (batch, heads, seqlen, dim)
-    scale = torch.amax(val.abs(), axis=(1, 3), keepdim=True)
-    scale = scale / 127
-    return (val / scale).to(torch.int8), scale
+    # val is (batch, heads, seqlen, dim), one scale per head and position.
+    quant, scale = quantize.quantize_jax_int8(
+        torchjax.from_torch(val), reduce_axis=(3,)
+    )
+    return torchjax.to_torch((quant, scale))
 
   def update(self, xk, xv):
     """Update kv cache"""
     k_quant, kscale = self.quantize(xk)
     v_quant, vscale = self.quantize(xv)
-    self.cache_k[:, :, self.input_pos, :] = k_quant
-    self.cache_v[:, :, self.input_pos, :] = v_quant
-    self.k_scaler[:, :, self.input_pos, :] = kscale
-    self.v_scaler[:, :, self.input_pos, :] = vscale
+    caches = torchjax.from_torch(
+        (self.cache_k, self.cache_v, self.k_scaler, self.v_scaler)
+    )
+    updates = torchjax.from_torch((k_quant, v_quant, kscale, vscale))
+    caches = _int8_scatter(caches, updates, self.input_pos)
+    self.cache_k, self.cache_v, self.k_scaler, self.v_scaler = (
+        torchjax.to_torch(caches)
+    )
     return self.cache_k, self.cache_v, self.k_scaler, self.v_scaler
@@ -15,6 +15,8 @@
 from typing import Tuple, Dict
 
 import dataclasses
+import functools
+import re
 import yaml
 
 import jax
@@ -99,6 +101,9 @@ class JetEngineEnvironment:
     self.y_sharding = jsharding.NamedSharding(self._mesh, P(None, "x"))
     self.x_sharding = jsharding.NamedSharding(self._mesh, P("x"))
     self.replicated = jsharding.NamedSharding(self._mesh, P())
+    # Shardings are memoized so that every layer gets the same object.
+    self._sharding_by_axis_cache = {None: self.replicated}
+    self._sharding_by_name_cache = {}
 
     if data.shard_on_batch:
       cache_sharding_axis = 0
@@ -137,13 +142,16 @@ class JetEngineEnvironment:
 
   def sharding_by_axis(self, axis):
     """return sharding partition spc by axis, options are x, y, -1 or Noe"""
-    if axis == -1 or axis is None:
-      return jsharding.NamedSharding(self._mesh, jax.sharding.PartitionSpec())
+    if axis == -1:
+      axis = None
+    if axis in self._sharding_by_axis_cache:
+      return self._sharding_by_axis_cache[axis]
     sharding = [None] * (axis + 1)
     sharding[axis] = "x"
     sharding_spec = jsharding.NamedSharding(
         self._mesh, jax.sharding.PartitionSpec(*sharding)
     )
+    self._sharding_by_axis_cache[axis] = sharding_spec
     return sharding_spec
 
   def make_caches_prefill(self):
@@ -178,32 +186,35 @@ class JetEngineEnvironment:
     if self.shard_on_batch:
       return self.sharding_by_axis(0)  # batch dimension
 
-    if name in self._sharding_config:
-      return self.sharding_by_axis(self._sharding_config[name])
+    if name in self._sharding_by_name_cache:
+      return self._sharding_by_name_cache[name]
 
-    name = process_sharding_name(name)
     if name in self._sharding_config:
-      return self.sharding_by_axis(self._sharding_config[name])
+      axis = self._sharding_config[name]
+    else:
+      processed_name = process_sharding_name(name)
+      if processed_name not in self._sharding_config:
+        raise RuntimeError(
+            "Sharding for name: ", processed_name, " not specified"
+        )
+      axis = self._sharding_config[processed_name]
+
+    sharding_spec = self.sharding_by_axis(axis)
+    self._sharding_by_name_cache[name] = sharding_spec
+    return sharding_spec
+
 
-    raise RuntimeError("Sharding for name: ", name, " not specified")
+_INT_RE = re.compile(r"\d+")
 
 
+@functools.lru_cache(maxsize=2048)
 def process_sharding_name(name):
   """Replace integers in param name with *.
 
   Presumably all layers should have the same sharding.
   """
-
-  def is_integer(t):
-    try:
-      int(t)
-      return True
-    # pylint: disable-next=all
-    except:  # noqa: E722
-      return False
-
   tokens = name.split(".")
   for i, t in enumerate(tokens):
-    if is_integer(t):
+    if _INT_RE.fullmatch(t):
       tokens[i] = "*"
   return ".".join(tokens)
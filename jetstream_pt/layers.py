@@ -201,19 +201,26 @@ class Int8KVAttentionKernel:
       keys, values, k_scaler, v_scaler = cache.update(xk, xv)
       keys = repeat_kv(keys, n_rep)
       values = repeat_kv(values, n_rep)
+      # Scalers are (batch, num_kv_heads, max_seqlen, 1), one per head.
+      k_scaler = repeat_kv(k_scaler, n_rep).reshape(
+          bsz, num_heads, 1, keys.shape[2]
+      )
+      v_scaler = repeat_kv(v_scaler, n_rep).reshape(
+          bsz, num_heads, 1, keys.shape[2]
+      )
     with jax.named_scope("attn_mat1"):
       ## Attention start
       # scores = torch.einsum(jnp.einsum, "ijkl,ikml->ikjm", xq, keys) / math.sqrt(self.head_dim)
       scores = (
           torch.einsum("ikjl,ikml->ikjm", xq, keys)
           / math.sqrt(head_dim)
-          * (k_scaler.reshape(bsz, 1, 1, keys.shape[2]))
+          * k_scaler
       )
       if mask is not None:
         scores = scores + mask  # (bs, n_local_heads, seqlen, max_seqlen)
     with jax.named_scope("attn_soft"):
       scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-      scores = scores * v_scaler.reshape((bsz, 1, 1, keys.shape[2]))
+      scores = scores * v_scaler
 
     with jax.named_scope("attn_mat2"):
       # output = torch.einsum(
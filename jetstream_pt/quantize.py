@@ -12,6 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+
+import jax
+import jax.numpy as jnp
 import torch
 
 
@@ -24,6 +28,15 @@ def quantize_torch_int8(val, reduce_axis):
   return (val / scale).to(torch.int8), scale
 
 
+@functools.partial(jax.jit, static_argnames=("reduce_axis",))
+def quantize_jax_int8(val, reduce_axis):
+  """quantize jax int8, same numerics as quantize_torch_int8 in one kernel"""
+  scale = jnp.max(jnp.abs(val), axis=reduce_axis, keepdims=True)
+  scale = scale / 127
+  scale = jnp.where(scale == 0, jnp.ones_like(scale), scale)
+  return (val / scale).astype(jnp.int8), scale
+
+
 def dequantize_torch_int8(val, scale):
   """dequantize torch int8"""
   return val * scale
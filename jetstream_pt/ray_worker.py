@@ -504,10 +504,9 @@ class PyTorchRayWorker:
 
       @functools.partial(jax.jit, donate_argnums=(0, 1), inline=True)
       def insert(cache, scaler, new_entry):
-        reduce_axis = (1, 3)
-        vals, scales = torchjax.call_torch(
-            quantize.quantize_torch_int8, new_entry, reduce_axis
-        )
+        reduce_axis = (3,)
+        vals, scales = quantize.quantize_jax_int8(new_entry, reduce_axis)
+        scales = scales.astype(scaler.dtype)
         new_scaler = jax.lax.dynamic_update_slice(
             scaler,
             scales,
@@ -603,10 +602,9 @@ class PyTorchRayWorker:
       @functools.partial(jax.jit, donate_argnums=(0, 1), inline=True)
       def insert(cache, scaler, new_entry):
         new_entry = jnp.transpose(new_entry.squeeze(0), (1, 0, 2))
-        reduce_axis = (1, 2)
-        vals, scales = torchjax.call_torch(
-            quantize.quantize_torch_int8, new_entry, reduce_axis
-        )
+        reduce_axis = (2,)
+        vals, scales = quantize.quantize_jax_int8(new_entry, reduce_axis)
+        scales = scales.astype(scaler.dtype)
         new_scaler = scaler.at[slot, :, update_indexes, :].set(scales)
         new_scaler = jax.lax.with_sharding_constraint(
             new_scaler, self.replicated
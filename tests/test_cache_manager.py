@@ -0,0 +1,96 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import jax
+import jax.numpy as jnp
+
+from jetstream_pt import cache_manager
+from jetstream_pt import torchjax
+
+
+class CacheManagerTest(unittest.TestCase):
+  """test kv cache managers"""
+
+  def test_kv_cache_update_int_position(self):
+    """test update of an empty kv cache, whose position is the int 0"""
+    cache_shape = (3, 2, 100, 2)  # bs, num heads, seqlen, dim
+    with jax.default_device(jax.devices("cpu")[0]):
+      cache = cache_manager.KVCacheGenerate.empty(cache_shape, None, False)
+      k = jnp.ones((3, 2, 1, 2), dtype=jnp.float32)
+      v = jnp.full((3, 2, 1, 2), 2, dtype=jnp.float32)
+
+      new_k, new_v = cache.update(*torchjax.to_torch((k, v)))
+
+      self.assertTrue(jnp.array_equal(new_k.jax()[:, :, 0:1, :], k))
+      self.assertTrue(jnp.array_equal(new_v.jax()[:, :, 0:1, :], v))
+      self.assertEqual(jnp.count_nonzero(new_k.jax()[:, :, 1:, :]), 0)
+
+  def test_int8_kv_cache_update_int_position(self):
+    """test update of an empty int8 kv cache, whose position is the int 0"""
+    cache_shape = (3, 2, 100, 2)  # bs, num heads, seqlen, dim
+    with jax.default_device(jax.devices("cpu")[0]):
+      cache = cache_manager.Int8KVCacheGenerate.empty(cache_shape, None, False)
+      k = jax.random.normal(jax.random.PRNGKey(0), (3, 2, 1, 2))
+      v = jax.random.normal(jax.random.PRNGKey(1), (3, 2, 1, 2))
+
+      new_k, _, scaler_k, _ = cache.update(*torchjax.to_torch((k, v)))
+      new_k = new_k.jax() * scaler_k.jax()
+
+      self.assertTrue(jnp.allclose(k, new_k[:, :, 0:1, :], atol=0.1))
+
+  def test_kv_cache_prefill_pytree_round_trip(self):
+    """test flatten and unflatten of prefill caches, with and without data"""
+    with jax.default_device(jax.devices("cpu")[0]):
+      cache = cache_manager.KVCachePrefill(kv_quantize=True)
+      leaves, treedef = jax.tree_util.tree_flatten(cache)
+      self.assertEqual(leaves, [])
+      restored = jax.tree_util.tree_unflatten(treedef, leaves)
+      self.assertIsNone(restored.cache_k)
+      self.assertIsNone(restored.cache_v)
+      self.assertTrue(restored.kv_quantize)
+
+      k = jnp.ones((3, 2, 10, 2), dtype=jnp.float32)
+      v = jnp.full((3, 2, 10, 2), 2, dtype=jnp.float32)
+      cache = cache_manager.KVCachePrefill()
+      cache.update(*torchjax.to_torch((k, v)))
+      leaves, treedef = jax.tree_util.tree_flatten(cache)
+      self.assertEqual(len(leaves), 2)
+      restored = jax.tree_util.tree_unflatten(treedef, leaves)
+      self.assertTrue(jnp.array_equal(restored.cache_k.jax(), k))
+      self.assertTrue(jnp.array_equal(restored.cache_v.jax(), v))
+      self.assertFalse(restored.kv_quantize)
+
+  def test_kv_cache_generate_pytree_round_trip(self):
+    """test flatten and unflatten of generate caches with list and array pos"""
+    cache_shape = (3, 2, 100, 2)  # bs, num heads, seqlen, dim
+    with jax.default_device(jax.devices("cpu")[0]):
+      k = jax.random.normal(jax.random.PRNGKey(0), cache_shape)
+      v = jax.random.normal(jax.random.PRNGKey(1), cache_shape)
+      for pos in ([3], jnp.full((1,), 3, dtype=jnp.int32)):
+        cache = cache_manager.KVCacheGenerate(
+            *torchjax.to_torch((k, v)), pos, None
+        )
+        leaves, treedef = jax.tree_util.tree_flatten(cache)
+        self.assertEqual(len(leaves), 3)
+        restored = jax.tree_util.tree_unflatten(treedef, leaves)
+        self.assertTrue(jnp.array_equal(restored.cache_k.jax(), k))
+        self.assertTrue(jnp.array_equal(restored.cache_v.jax(), v))
+        self.assertEqual(type(restored.pos), type(pos))
+        self.assertTrue(jnp.array_equal(jnp.asarray(restored.pos), pos))
+        self.assertIsNone(restored.sharding)
+
+
+if __name__ == "__main__":
+  unittest.main()
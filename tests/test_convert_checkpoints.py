@@ -0,0 +1,165 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from etils import epath
+from safetensors.torch import load_file, save_file
+import torch
+
+import convert_checkpoints
+
+
+class ConvertCheckpointsTest(unittest.TestCase):
+  """test checkpoint conversion helpers"""
+
+  def test_save_safetensors_streaming(self):
+    """test round trip of the streaming safetensors writer"""
+    state_dict = {
+        "bf16": torch.randn((3, 4), dtype=torch.bfloat16),
+        "f32": torch.randn((2, 5)),
+        "int8": torch.arange(-5, 5, dtype=torch.int8),
+        "bool": torch.tensor([True, False, True]),
+        "scalar": torch.tensor(2.0),
+        "empty": torch.zeros((0, 3)),
+        "non_contiguous": torch.randn((6, 4))[:, 1:3],
+    }
+    expected = {k: v.clone() for k, v in state_dict.items()}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, "model.safetensors")
+      convert_checkpoints._save_safetensors_streaming(state_dict, path)
+      loaded = load_file(path)
+
+    self.assertEqual(state_dict, {})
+    self.assertEqual(set(loaded), set(expected))
+    for key, tensor in expected.items():
+      self.assertEqual(loaded[key].dtype, tensor.dtype, key)
+      self.assertTrue(torch.equal(loaded[key], tensor), key)
+
+  def test_save_safetensors_streaming_unsupported_dtype(self):
+    """test the writer rejects dtypes safetensors cannot store"""
+    state_dict = {"freqs_cis": torch.zeros(2, dtype=torch.complex64)}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, "model.safetensors")
+      with self.assertRaisesRegex(ValueError, "freqs_cis"):
+        convert_checkpoints._save_safetensors_streaming(state_dict, path)
+
+  def test_quantize_torch_int8_compiled_matches_eager(self):
+    """test the compiled weight quantization matches eager on bf16"""
+    torch.manual_seed(0)
+    val = torch.randn((256, 512), dtype=torch.bfloat16)
+    for axis in (0, 1):
+      vals, scale = convert_checkpoints._quantize_torch_int8(val, (axis,))
+      expected_vals, expected_scale = convert_checkpoints._quantize_weight_int8(
+          val, (axis,)
+      )
+      self.assertEqual(scale.dtype, torch.bfloat16)
+      self.assertTrue(torch.equal(vals, expected_vals))
+      self.assertTrue(torch.equal(scale, expected_scale))
+
+  def test_merge_llama_weights_enable_float32(self):
+    """test merged shards are concatenated and cast to float32"""
+    shards = [
+        {
+            "tok_embeddings.weight": torch.randn((4, 3), dtype=torch.bfloat16),
+            "layers.0.attention.wq.weight": torch.randn(
+                (2, 4), dtype=torch.bfloat16
+            ),
+            "norm.weight": torch.ones(4, dtype=torch.bfloat16),
+        }
+        for _ in range(2)
+    ]
+    state_dict = convert_checkpoints._merge_llama_weights(
+        shards, minimize_memory_footprint=False, enable_float32=True
+    )
+    expected = {
+        "tok_embeddings.weight": torch.cat(
+            [s["tok_embeddings.weight"] for s in shards], 1
+        ),
+        "layers.0.attention.wq.weight": torch.cat(
+            [s["layers.0.attention.wq.weight"] for s in shards], 0
+        ),
+        "norm.weight": shards[0]["norm.weight"],
+    }
+    for key, tensor in expected.items():
+      self.assertEqual(state_dict[key].dtype, torch.float32, key)
+      self.assertTrue(torch.equal(state_dict[key], tensor.float()), key)
+
+  def test_cat_as_shape_mismatch(self):
+    """test shards must only differ in the concatenated dim"""
+    merged = convert_checkpoints._cat_as(
+        [torch.ones((2, 3)), torch.ones((2, 5))], 1, torch.float32
+    )
+    self.assertEqual(merged.shape, (2, 8))
+    with self.assertRaises(RuntimeError):
+      convert_checkpoints._cat_as(
+          [torch.ones((2, 3)), torch.ones((4, 3))], 1, torch.float32
+      )
+
+  def test_tensors_are_identical(self):
+    """test replicated shards only match with the same shape and values"""
+    ones = torch.ones(4)
+    self.assertTrue(convert_checkpoints._tensors_are_identical([ones, ones]))
+    self.assertTrue(
+        convert_checkpoints._tensors_are_identical([ones, torch.ones(4)])
+    )
+    self.assertFalse(
+        convert_checkpoints._tensors_are_identical([ones, torch.zeros(4)])
+    )
+    self.assertFalse(
+        convert_checkpoints._tensors_are_identical([ones, torch.ones(1)])
+    )
+    self.assertFalse(
+        convert_checkpoints._tensors_are_identical([ones, ones[:2]])
+    )
+    square = torch.arange(9.0).reshape(3, 3)
+    self.assertTrue(
+        convert_checkpoints._tensors_are_identical([square, square.view(3, 3)])
+    )
+    self.assertFalse(
+        convert_checkpoints._tensors_are_identical([square, square.t()])
+    )
+
+  def test_lazy_safetensors_checkpoint(self):
+    """test the lazy checkpoint reads on demand and closes when emptied"""
+    tensors = {"a": torch.randn((2, 3)), "b": torch.arange(4)}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, "model.safetensors")
+      save_file(tensors, path)
+      checkpoint = convert_checkpoints._LazySafetensorsCheckpoint(path)
+
+      self.assertEqual(set(checkpoint), {"a", "b"})
+      self.assertTrue(torch.equal(checkpoint["a"], tensors["a"]))
+      del checkpoint["a"]
+      self.assertNotIn("a", checkpoint)
+      self.assertIsNotNone(checkpoint._file)
+      del checkpoint["b"]
+      self.assertEqual(len(checkpoint), 0)
+      self.assertIsNone(checkpoint._file)
+
+  def test_load_from_local_rejects_mixed_formats(self):
+    """test loading fails when both safetensors and pth shards are present"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      input_dir = epath.Path(tmp_dir)
+      (input_dir / "params.json").write_text("{}")
+      save_file({"a": torch.ones(2)}, os.fspath(input_dir / "a.safetensors"))
+      torch.save({"a": torch.ones(2)}, os.fspath(input_dir / "a.pth"))
+      with self.assertRaisesRegex(ValueError, "both"):
+        convert_checkpoints._load_from_local(input_dir)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -61,7 +61,11 @@ class QuantizationTest(unittest.TestCase):
       cache_k_jax = jax.random.normal(key, cache_shape)
       cache_v_jax = jax.random.normal(key2, cache_shape)
 
-      cache_k, cache_v = torchjax.to_torch((cache_k_jax, cache_v_jax))
+      # KVCacheGenerate.update donates the cache buffers, so hand it copies
+      # and keep the originals for the int8 cache below.
+      cache_k, cache_v = torchjax.to_torch(
+          (jnp.copy(cache_k_jax), jnp.copy(cache_v_jax))
+      )
 
       cache = cache_manager.KVCacheGenerate(cache_k, cache_v, [0], None)
 
@@ -78,18 +82,51 @@ class QuantizationTest(unittest.TestCase):
       # ==
 
       cache_k, cache_v = torchjax.to_torch((cache_k_jax, cache_v_jax))
-      cache_k_int, cache_k_scaler = quantize.quantize_torch_int8(
-          cache_k, (1, 3)
+      cache_k_int, cache_k_scaler = quantize.quantize_torch_int8(cache_k, (3,))
+      cache_v_int, cache_v_scaler = quantize.quantize_torch_int8(cache_v, (3,))
+      cache_int = cache_manager.Int8KVCacheGenerate(
+          cache_k_int, cache_v_int, cache_k_scaler, cache_v_scaler, [0], None
       )
-      cache_v_int, cache_v_scaler = quantize.quantize_torch_int8(
-          cache_v, (1, 3)
+      attention_quant = layers.Int8KVAttentionKernel(env)
+      int_res = attention_quant(xq, xk, xv, None, cache_int)
+
+      self.assertTrue(jnp.allclose(float_res.jax(), int_res.jax(), atol=0.01))
+
+  def test_kv_kernel_grouped_query(self):
+    """test kv cache quantization with more query heads than kv heads"""
+    cache_shape = (3, 2, 100, 2)  # bs, num kv heads, seqlen, dim
+    with jax.default_device(jax.devices("cpu")[0]):
+      env, _ = helpers.make_env_tiny(False)
+      key = jax.random.PRNGKey(123)
+      key2 = jax.random.PRNGKey(456)
+      cache_k_jax = jax.random.normal(key, cache_shape)
+      cache_v_jax = jax.random.normal(key2, cache_shape)
+
+      cache_k, cache_v = torchjax.to_torch(
+          (jnp.copy(cache_k_jax), jnp.copy(cache_v_jax))
       )
+      cache = cache_manager.KVCacheGenerate(cache_k, cache_v, [0], None)
+
+      # 4 query heads share the 2 kv heads, 1 is seqlen
+      xq = jax.random.normal(key, (3, 4, 1, 2))
+      xk = jax.random.normal(key, (3, 2, 1, 2))
+      xv = jax.random.normal(key, (3, 2, 1, 2))
+
+      xq, xk, xv = torchjax.to_torch((xq, xk, xv))
+
+      attention_float = layers.AttentionKernel(env)
+      float_res = attention_float(xq, xk, xv, None, cache)
+
+      cache_k, cache_v = torchjax.to_torch((cache_k_jax, cache_v_jax))
+      cache_k_int, cache_k_scaler = quantize.quantize_torch_int8(cache_k, (3,))
+      cache_v_int, cache_v_scaler = quantize.quantize_torch_int8(cache_v, (3,))
       cache_int = cache_manager.Int8KVCacheGenerate(
           cache_k_int, cache_v_int, cache_k_scaler, cache_v_scaler, [0], None
       )
       attention_quant = layers.Int8KVAttentionKernel(env)
       int_res = attention_quant(xq, xk, xv, None, cache_int)
 
+      self.assertEqual(int_res.shape, (3, 4, 1, 2))
       self.assertTrue(jnp.allclose(float_res.jax(), int_res.jax(), atol=0.01))
 
 